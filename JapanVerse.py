@@ -1,12 +1,21 @@
 from __future__ import annotations
-from dataclasses import dataclass, field
-from typing import Any, Callable, Dict, Generic, Iterator, List, Optional, Tuple, TypeVar
-from functools import reduce
+from dataclasses import dataclass, field, fields
+from typing import Any, Callable, Collection, Dict, Generic, Iterable, Iterator, List, Optional, Tuple, TypeVar
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+from itertools import chain
+import heapq
+import os
 import time
 
 T = TypeVar("T")
 
+TRACE_ENABLED = bool(os.environ.get("JV_TRACE"))
+
 def traced(fn: Callable[..., T]) -> Callable[..., T]:
+    if not TRACE_ENABLED:
+        return fn
     def wrapper(*args, **kwargs):
         start = time.perf_counter()
         result = fn(*args, **kwargs)
@@ -19,20 +28,30 @@ def ensure(condition: bool, message: str) -> None:
     if not condition:
         raise ValueError(message)
 
+@lru_cache(maxsize=4096)
 def normalize_str(value: str) -> str:
     return " ".join(value.strip().lower().split())
 
-@dataclass
+def binge_score_of(rating: float, episodes: int) -> float:
+    if episodes == 0:
+        return rating
+    return round((rating * 10) / (1 + episodes / 12), 2)
+
+@dataclass(slots=True)
 class Entity:
     id: int
     name: str
     tags: Tuple[str, ...] = field(default_factory=tuple)
+    _name_norm: str = field(default="", init=False, repr=False, compare=False)
 
     def __post_init__(self):
-        ensure(isinstance(self.id, int) and self.id >= 0, "Invalid id")
-        ensure(isinstance(self.name, str) and self.name.strip(), "Invalid name")
+        if not (isinstance(self.id, int) and self.id >= 0):
+            raise ValueError("Invalid id")
+        if not (isinstance(self.name, str) and self.name.strip()):
+            raise ValueError("Invalid name")
         self.name = self.name.strip()
-        self.tags = tuple(map(lambda t: normalize_str(str(t)), self.tags))
+        self._name_norm = normalize_str(self.name)
+        self.tags = tuple(normalize_str(t if isinstance(t, str) else str(t)) for t in self.tags)
 
     @property
     def kind(self) -> str:
@@ -41,114 +60,233 @@ class Entity:
     def has_tag(self, tag: str) -> bool:
         return normalize_str(tag) in self.tags
 
-@dataclass
+@dataclass(slots=True)
 class Media(Entity):
     year: int = 0
     rating: float = 0.0
     studio: str = ""
+    _studio_norm: str = field(default="", init=False, repr=False, compare=False)
 
     def __post_init__(self):
-        super().__post_init__()
-        ensure(1900 <= self.year <= 2100, "Invalid year")
-        ensure(0.0 <= self.rating <= 10.0, "Invalid rating")
+        super(Media, self).__post_init__()
+        if not 1900 <= self.year <= 2100:
+            raise ValueError("Invalid year")
+        if not 0.0 <= self.rating <= 10.0:
+            raise ValueError("Invalid rating")
         self.studio = self.studio.strip()
+        self._studio_norm = normalize_str(self.studio)
 
     def is_classic(self) -> bool:
         return self.year <= 2005 and self.rating >= 8.0
 
-@dataclass
+@dataclass(slots=True)
 class Anime(Media):
     episodes: int = 0
     genre: str = ""
+    _binge_score: Optional[float] = field(default=None, init=False, repr=False, compare=False)
 
     def __post_init__(self):
-        super().__post_init__()
-        ensure(self.episodes >= 0, "Invalid episodes")
+        super(Anime, self).__post_init__()
+        if self.episodes < 0:
+            raise ValueError("Invalid episodes")
         self.genre = self.genre.strip()
+        self._binge_score = None
 
     def binge_score(self) -> float:
-        if self.episodes == 0:
-            return self.rating
-        return round((self.rating * 10) / (1 + self.episodes / 12), 2)
+        score = self._binge_score
+        if score is None:
+            score = self._binge_score = binge_score_of(self.rating, self.episodes)
+        return score
 
-@dataclass
+@dataclass(slots=True)
 class Drama(Media):
     seasons: int = 1
     platform: str = ""
 
     def __post_init__(self):
-        super().__post_init__()
-        ensure(self.seasons >= 1, "Invalid seasons")
+        super(Drama, self).__post_init__()
+        if self.seasons < 1:
+            raise ValueError("Invalid seasons")
         self.platform = self.platform.strip()
 
-@dataclass
+@dataclass(slots=True)
 class Tech(Entity):
     field: str = ""
     year: int = 0
 
     def __post_init__(self):
-        super().__post_init__()
-        ensure(1900 <= self.year <= 2100, "Invalid tech year")
+        super(Tech, self).__post_init__()
+        if not 1900 <= self.year <= 2100:
+            raise ValueError("Invalid tech year")
         self.field = self.field.strip()
 
-@dataclass
+@dataclass(slots=True)
 class Company(Tech):
     hq_city: str = ""
 
     def __post_init__(self):
-        super().__post_init__()
+        super(Company, self).__post_init__()
         self.hq_city = self.hq_city.strip()
 
-@dataclass
+@dataclass(slots=True)
 class Gadget(Tech):
     maker: str = ""
     spec_score: int = 0
 
     def __post_init__(self):
-        super().__post_init__()
-        ensure(0 <= self.spec_score <= 100, "Invalid spec score")
+        super(Gadget, self).__post_init__()
+        if not 0 <= self.spec_score <= 100:
+            raise ValueError("Invalid spec score")
         self.maker = self.maker.strip()
 
-@dataclass
+@dataclass(slots=True)
 class Link(Entity):
     src_id: int = 0
     dst_id: int = 0
     rel: str = ""
 
     def __post_init__(self):
-        super().__post_init__()
-        ensure(self.src_id >= 0 and self.dst_id >= 0, "Invalid link ids")
+        super(Link, self).__post_init__()
+        if not (self.src_id >= 0 and self.dst_id >= 0):
+            raise ValueError("Invalid link ids")
         self.rel = normalize_str(self.rel)
 
 class Index:
+    SMALL_BUCKET = 64
+    ARRAY_ID_LIMIT = 1 << 63
+
     def __init__(self, key_fn: Callable[[Entity], Any]):
         self.key_fn = key_fn
-        self.map: Dict[Any, set[int]] = {}
+        self.map: Dict[Any, array | set[int]] = {}
 
     def add(self, row: Entity):
-        key = self.key_fn(row)
-        self.map.setdefault(key, set()).add(row.id)
+        self._add_id(self.key_fn(row), row.id)
+
+    def add_many(self, rows: Iterable[Entity]):
+        key_fn = self.key_fn
+        grouped: Dict[Any, List[int]] = {}
+        for row in rows:
+            grouped.setdefault(key_fn(row), []).append(row.id)
+        self._merge(grouped)
+
+    def remove(self, row: Entity):
+        self._remove_id(self.key_fn(row), row.id)
+
+    def lookup(self, key: Any) -> Collection[int]:
+        # Returns the live bucket: callers must not mutate it or write to the table while iterating it.
+        return self.map.get(key, ())
+
+    def _add_id(self, key: Any, row_id: int):
+        bucket = self.map.get(key)
+        if bucket is None:
+            self.map[key] = array("q", (row_id,)) if row_id < self.ARRAY_ID_LIMIT else {row_id}
+        elif isinstance(bucket, set):
+            bucket.add(row_id)
+        elif row_id >= self.ARRAY_ID_LIMIT:
+            self.map[key] = {*bucket, row_id}
+        else:
+            i = bisect_left(bucket, row_id)
+            if i < len(bucket) and bucket[i] == row_id:
+                return
+            # Small buckets are copy-on-write so an iterator over an earlier lookup never sees ids shift.
+            bucket = bucket[:i] + array("q", (row_id,)) + bucket[i:]
+            self.map[key] = set(bucket) if len(bucket) > self.SMALL_BUCKET else bucket
+
+    def _merge(self, grouped: Dict[Any, List[int]]):
+        for key, ids in grouped.items():
+            bucket = self.map.get(key)
+            if isinstance(bucket, set):
+                bucket.update(ids)
+                continue
+            merged = sorted(set(ids).union(bucket) if bucket is not None else set(ids))
+            if len(merged) > self.SMALL_BUCKET or merged[-1] >= self.ARRAY_ID_LIMIT:
+                self.map[key] = set(merged)
+            else:
+                self.map[key] = array("q", merged)
+
+    def _remove_id(self, key: Any, row_id: int):
+        bucket = self.map.get(key)
+        if bucket is None:
+            return
+        if isinstance(bucket, set):
+            bucket.discard(row_id)
+            if len(bucket) < self.SMALL_BUCKET // 2 and all(i < self.ARRAY_ID_LIMIT for i in bucket):
+                self.map[key] = bucket = array("q", sorted(bucket))
+        else:
+            i = bisect_left(bucket, row_id)
+            if i < len(bucket) and bucket[i] == row_id:
+                self.map[key] = bucket = bucket[:i] + bucket[i + 1:]
+        if not bucket:
+            del self.map[key]
+
+class AggregateIndex:
+    def __init__(self, key_fn: Callable[[Entity], Any], value_fn: Callable[[Entity], float]):
+        self.key_fn = key_fn
+        self.value_fn = value_fn
+        self.map: Dict[Any, List[float]] = {}
+
+    def add(self, row: Entity):
+        acc = self.map.setdefault(self.key_fn(row), [0.0, 0])
+        acc[0] += self.value_fn(row)
+        acc[1] += 1
+
+    def add_many(self, rows: Iterable[Entity]):
+        key_fn, value_fn = self.key_fn, self.value_fn
+        for row in rows:
+            acc = self.map.setdefault(key_fn(row), [0.0, 0])
+            acc[0] += value_fn(row)
+            acc[1] += 1
 
     def remove(self, row: Entity):
         key = self.key_fn(row)
         if key in self.map:
-            self.map[key].discard(row.id)
-            if not self.map[key]:
+            acc = self.map[key]
+            acc[0] -= self.value_fn(row)
+            acc[1] -= 1
+            if acc[1] <= 0:
                 del self.map[key]
 
-    def lookup(self, key: Any) -> set[int]:
-        return set(self.map.get(key, set()))
+    def items(self) -> Iterator[Tuple[Any, float, int]]:
+        return ((key, total, count) for key, (total, count) in self.map.items())
+
+class SearchCorpus:
+    def __init__(self):
+        self.map: Dict[int, Tuple[bytes, Entity]] = {}
+
+    def add(self, row: Entity):
+        self.map[row.id] = (row._name_norm.encode("utf-8"), row)
+
+    def add_many(self, rows: Iterable[Entity]):
+        self.map.update((row.id, (row._name_norm.encode("utf-8"), row)) for row in rows)
+
+    def remove(self, row: Entity):
+        self.map.pop(row.id, None)
+
+    def entries(self) -> Iterator[Tuple[bytes, Entity]]:
+        return iter(self.map.values())
 
 class Table(Generic[T]):
-    def __init__(self, name: str):
+    def __init__(self, name: str, searchable: bool = False):
         self.name = name
         self.rows: Dict[int, T] = {}
         self.indices: Dict[str, Index] = {}
+        self.aggregates: Dict[str, AggregateIndex] = {}
+        self.corpus: Optional[SearchCorpus] = SearchCorpus() if searchable else None
         self.history_log: List[str] = []
+        self._by_type: Dict[type, Dict[int, T]] = {}
 
     def create_index(self, name: str, key_fn: Callable[[T], Any]):
+        self.attach_index(name, Index(key_fn))
+
+    def create_aggregate(self, name: str, key_fn: Callable[[T], Any], value_fn: Callable[[T], float]):
+        ensure(name not in self.aggregates, "Aggregate exists")
+        agg = AggregateIndex(key_fn, value_fn)
+        agg.add_many(self.rows.values())
+        self.aggregates[name] = agg
+        self.history_log.append(f"AGGREGATE {self.name}.{name}")
+
+    def attach_index(self, name: str, idx: Index):
         ensure(name not in self.indices, "Index exists")
-        idx = Index(key_fn)
         for row in self.rows.values():
             idx.add(row)
         self.indices[name] = idx
@@ -158,77 +296,125 @@ class Table(Generic[T]):
     def insert(self, row: T):
         ensure(row.id not in self.rows, "Duplicate id")
         self.rows[row.id] = row
+        self._by_type.setdefault(type(row), {})[row.id] = row
         for idx in self.indices.values():
             idx.add(row)
+        for agg in self.aggregates.values():
+            agg.add(row)
+        if self.corpus is not None:
+            self.corpus.add(row)
         self.history_log.append(f"INSERT {self.name} {row.id}")
 
+    @traced
+    def insert_many(self, rows: Iterable[T]):
+        rows = list(rows)
+        ids = [row.id for row in rows]
+        ensure(len(set(ids)) == len(ids) and self.rows.keys().isdisjoint(ids), "Duplicate id")
+        self.rows.update(zip(ids, rows))
+        for row in rows:
+            self._by_type.setdefault(type(row), {})[row.id] = row
+        for idx in self.indices.values():
+            idx.add_many(rows)
+        for agg in self.aggregates.values():
+            agg.add_many(rows)
+        if self.corpus is not None:
+            self.corpus.add_many(rows)
+        self.history_log.extend(f"INSERT {self.name} {i}" for i in ids)
+
     @traced
     def delete(self, row_id: int):
         ensure(row_id in self.rows, "Row not found")
         row = self.rows[row_id]
         for idx in self.indices.values():
             idx.remove(row)
+        for agg in self.aggregates.values():
+            agg.remove(row)
+        if self.corpus is not None:
+            self.corpus.remove(row)
         del self.rows[row_id]
+        bucket = self._by_type[type(row)]
+        del bucket[row_id]
+        if not bucket:
+            del self._by_type[type(row)]
         self.history_log.append(f"DELETE {self.name} {row_id}")
 
     @traced
     def update(self, row_id: int, **changes):
         ensure(row_id in self.rows, "Row not found")
         row = self.rows[row_id]
+        allowed = {f.name for f in fields(row) if f.init}
+        ensure(allowed.issuperset(changes), "Unknown field")
         for idx in self.indices.values():
             idx.remove(row)
+        for agg in self.aggregates.values():
+            agg.remove(row)
         for key, value in changes.items():
             setattr(row, key, value)
         row.__post_init__()
         for idx in self.indices.values():
             idx.add(row)
+        for agg in self.aggregates.values():
+            agg.add(row)
+        if self.corpus is not None:
+            self.corpus.add(row)
         self.history_log.append(f"UPDATE {self.name} {row_id}")
 
     def all(self) -> Iterator[T]:
         return iter(self.rows.values())
 
+    def of_type(self, cls: type) -> Iterator[T]:
+        buckets = (b.values() for t, b in self._by_type.items() if issubclass(t, cls))
+        return chain.from_iterable(buckets)
+
     def where(self, predicate: Callable[[T], bool]) -> Iterator[T]:
         return filter(predicate, self.rows.values())
 
     def by_index(self, index_name: str, key: Any) -> Iterator[T]:
         ensure(index_name in self.indices, "Index not found")
-        ids = self.indices[index_name].lookup(key)
-        return map(lambda i: self.rows[i], ids)
+        ids = tuple(self.indices[index_name].lookup(key))
+        return map(self.rows.__getitem__, ids)
+
+    def aggregate(self, name: str) -> Iterator[Tuple[Any, float, int]]:
+        ensure(name in self.aggregates, "Aggregate not found")
+        return self.aggregates[name].items()
 
 class JapanVerseDB:
     def __init__(self):
-        self.media = Table("media")
-        self.tech = Table("tech")
+        self.media = Table("media", searchable=True)
+        self.tech = Table("tech", searchable=True)
         self.links = Table("links")
         self.media.create_index("kind", lambda r: r.kind)
-        self.media.create_index("studio", lambda r: normalize_str(r.studio))
+        self.media.create_index("studio", lambda r: r._studio_norm)
+        self.media.create_aggregate("studio_rating", lambda r: r._studio_norm, lambda r: r.rating)
         self.tech.create_index("field", lambda r: normalize_str(r.field))
         self.links.create_index("rel", lambda r: r.rel)
 
     def search(self, keyword: str):
-        k = normalize_str(keyword)
-        return list(filter(lambda e: k in normalize_str(e.name), list(self.media.all()) + list(self.tech.all())))
+        kb = normalize_str(keyword).encode("utf-8")
+        entries = chain(self.media.corpus.entries(), self.tech.corpus.entries())
+        return [e for n, e in entries if kb in n]
 
     def top_anime(self, n: int):
-        animes = filter(lambda m: isinstance(m, Anime), self.media.all())
-        scored = map(lambda a: (a.binge_score(), a), animes)
-        return list(map(lambda x: x[1], sorted(scored, reverse=True)[:n]))
+        return heapq.nlargest(n, self.media.of_type(Anime), key=Anime.binge_score)
 
     def avg_rating_by_studio(self):
-        groups: Dict[str, List[float]] = {}
-        for m in self.media.all():
-            groups.setdefault(normalize_str(m.studio), []).append(m.rating)
-        return {k: round(reduce(lambda a, b: a + b, v) / len(v), 2) for k, v in groups.items()}
+        return {k: round(total / count, 2) for k, total, count in self.media.aggregate("studio_rating")}
 
 def seed(db: JapanVerseDB):
-    db.media.insert(Anime(1, "Steins;Gate", ("time travel", "tokyo"), 2011, 9.0, "White Fox", 24, "Sci-Fi"))
-    db.media.insert(Anime(2, "Vinland Saga", ("war", "growth"), 2019, 8.8, "WIT", 48, "Historical"))
-    db.media.insert(Drama(3, "Midnight Diner", ("tokyo", "food"), 2009, 8.4, "MBS", 3, "Netflix"))
-    db.tech.insert(Company(100, "Sony", ("hardware",), "electronics", 1946, "Tokyo"))
-    db.tech.insert(Gadget(200, "Aibo", ("robot", "ai"), "robotics", 1999, "Sony", 85))
-
-def print_entity(e: Entity):
-    print(e)
+    db.media.insert_many([
+        Anime(1, "Steins;Gate", ("time travel", "tokyo"), 2011, 9.0, "White Fox", 24, "Sci-Fi"),
+        Anime(2, "Vinland Saga", ("war", "growth"), 2019, 8.8, "WIT", 48, "Historical"),
+        Drama(3, "Midnight Diner", ("tokyo", "food"), 2009, 8.4, "MBS", 3, "Netflix"),
+    ])
+    db.tech.insert_many([
+        Company(100, "Sony", ("hardware",), "electronics", 1946, "Tokyo"),
+        Gadget(200, "Aibo", ("robot", "ai"), "robotics", 1999, "Sony", 85),
+    ])
+
+def print_entities(rows: Iterable[Entity]):
+    text = "\n".join(map(str, rows))
+    if text:
+        print(text)
 
 def run():
     db = JapanVerseDB()
@@ -237,12 +423,12 @@ def run():
         print("\n1 Media\n2 Tech\n3 Search\n4 Top Anime\n5 Avg Rating\n0 Exit")
         c = input("Choose: ").strip()
         if c == "1":
-            list(map(print_entity, db.media.all()))
+            print_entities(db.media.all())
         elif c == "2":
-            list(map(print_entity, db.tech.all()))
+            print_entities(db.tech.all())
         elif c == "3":
             k = input("Keyword: ")
-            list(map(print_entity, db.search(k)))
+            print_entities(db.search(k))
         elif c == "4":
             print(db.top_anime(3))
         elif c == "5":